@@ -7,12 +7,54 @@
 
 import os
 import sys
-import glob
+import logging
+from logging.handlers import MemoryHandler
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from process_sop_with_images import process_sop_document_with_images
 
+log = logging.getLogger("sop.batch")
+
+
+def setup_logging():
+    """
+    配置批处理日志：消息先缓存在MemoryHandler中，由批处理流程在每个文档完成后统一写出到标准输出
+    （缓存满100条或出现错误时也会写出）；重复调用不会重复添加handler
+    """
+    if not log.handlers:
+        stream_handler = logging.StreamHandler(sys.stdout)
+        stream_handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(MemoryHandler(capacity=100, flushLevel=logging.ERROR, target=stream_handler))
+    log.setLevel(logging.INFO)
+
+def flush_logging():
+    """将已缓存的批处理日志写出（每个文档完成后调用一次，保证进度实时可见）"""
+    for handler in log.handlers:
+        handler.flush()
+
+def list_files(directory: Path, suffixes: tuple) -> list:
+    """
+    单次 os.scandir 列出目录下指定后缀的文件（后缀不区分大小写）
+    结果按 suffixes 的顺序分组（如先 .docx 后 .doc），组内按文件名排序
+    """
+    try:
+        with os.scandir(directory) as entries:
+            matched = []
+            for entry in entries:
+                name = entry.name.lower()
+                for order, suffix in enumerate(suffixes):
+                    if name.endswith(suffix):
+                        if entry.is_file():
+                            matched.append((order, entry.name, Path(entry.path)))
+                        break
+    except FileNotFoundError:
+        return []
+    matched.sort()
+    return [path for _, _, path in matched]
+
 def batch_process_annotated_documents():
     """批量处理已标注的文档"""
+    setup_logging()
     
     # 设置路径
     current_dir = Path(__file__).parent
@@ -25,78 +67,86 @@ def batch_process_annotated_documents():
     images_dir.mkdir(exist_ok=True)
     
     # 查找所有Word文档
-    docx_files = list(annotated_dir.glob("*.docx"))
-    doc_files = list(annotated_dir.glob("*.doc"))
-    
-    all_files = docx_files + doc_files
+    all_files = list_files(annotated_dir, ('.docx', '.doc'))
     
     if not all_files:
-        print("❌ 在'标注完的文档'文件夹中未找到任何Word文档")
+        log.error("❌ 在'标注完的文档'文件夹中未找到任何Word文档")
         return
     
-    print(f"📁 找到 {len(all_files)} 个文档待处理:")
+    log.info("📁 找到 %d 个文档待处理:", len(all_files))
     for i, file_path in enumerate(all_files, 1):
-        print(f"  {i}. {file_path.name}")
+        log.info("  %d. %s", i, file_path.name)
     
-    print(f"\n🚀 开始批量处理...")
-    print("=" * 60)
+    log.info("\n🚀 开始批量处理...")
+    log.info("=" * 60)
+    flush_logging()
     
     success_count = 0
     error_count = 0
-    processed_files = []
+    processed_files = []  # 成功处理的文档路径（按完成顺序收集，汇总时按输入顺序输出）
     
-    for i, docx_path in enumerate(all_files, 1):
-        print(f"\n📄 处理文档 {i}/{len(all_files)}: {docx_path.name}")
-        print("-" * 40)
+    # 各文档之间相互独立，使用多进程并行处理（CPU密集：XML解析、正则、图片提取）
+    max_workers = min(os.cpu_count() or 1, len(all_files))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # 输出CSV到 output_dir，图片提取由处理函数内部固定到 sop_images
+        futures = {
+            executor.submit(process_sop_document_with_images, str(docx_path), str(output_dir)): docx_path
+            for docx_path in all_files
+        }
         
-        try:
-            # 处理文档
-            # 输出CSV到 output_dir，图片提取由处理函数内部固定到 sop_images
-            result = process_sop_document_with_images(str(docx_path), str(output_dir))
+        for i, future in enumerate(as_completed(futures), 1):
+            docx_path = futures[future]
+            log.info("\n📄 完成文档 %d/%d: %s", i, len(all_files), docx_path.name)
+            log.info("-" * 40)
             
-            if result:
+            error = future.exception()
+            if error is not None:
+                error_count += 1
+                log.error("❌ 处理出错: %s", docx_path.name)
+                log.error("   错误信息: %s", error)
+            elif future.result():
                 success_count += 1
-                processed_files.append(docx_path.name)
-                print(f"✅ 成功处理: {docx_path.name}")
+                processed_files.append(docx_path)
+                log.info("✅ 成功处理: %s", docx_path.name)
             else:
                 error_count += 1
-                print(f"❌ 处理失败: {docx_path.name}")
-                
-        except Exception as e:
-            error_count += 1
-            print(f"❌ 处理出错: {docx_path.name}")
-            print(f"   错误信息: {str(e)}")
+                log.error("❌ 处理失败: %s", docx_path.name)
+            flush_logging()
     
     # 输出处理结果统计
-    print("\n" + "=" * 60)
-    print("📊 批量处理完成统计:")
-    print(f"✅ 成功处理: {success_count} 个文档")
-    print(f"❌ 处理失败: {error_count} 个文档")
-    print(f"📁 总文档数: {len(all_files)} 个")
+    log.info("\n" + "=" * 60)
+    log.info("📊 批量处理完成统计:")
+    log.info("✅ 成功处理: %d 个文档", success_count)
+    log.info("❌ 处理失败: %d 个文档", error_count)
+    log.info("📁 总文档数: %d 个", len(all_files))
     
     if processed_files:
-        print(f"\n📋 成功处理的文档列表:")
-        for i, filename in enumerate(processed_files, 1):
-            print(f"  {i}. {filename}")
+        # 并行处理按完成先后返回，汇总列表按输入文档顺序排列，保证每次运行输出一致
+        input_order = {docx_path: i for i, docx_path in enumerate(all_files)}
+        processed_files.sort(key=input_order.__getitem__)
+        log.info("\n📋 成功处理的文档列表:")
+        for i, docx_path in enumerate(processed_files, 1):
+            log.info("  %d. %s", i, docx_path.name)
     
     # 显示输出文件
-    print(f"\n📂 输出文件位置:")
-    print(f"  CSV文件: {output_dir}")
-    print(f"  图片文件: {images_dir}")
+    log.info("\n📂 输出文件位置:")
+    log.info("  CSV文件: %s", output_dir)
+    log.info("  图片文件: %s", images_dir)
     
     # 列出生成的CSV文件
-    csv_files = list(output_dir.glob("*_processed_with_images.csv"))
+    csv_files = list_files(output_dir, ('_processed_with_images.csv',))
     if csv_files:
-        print(f"\n📄 生成的CSV文件 ({len(csv_files)} 个):")
+        log.info("\n📄 生成的CSV文件 (%d 个):", len(csv_files))
         for csv_file in sorted(csv_files):
-            print(f"  - {csv_file.name}")
+            log.info("  - %s", csv_file.name)
     
     # 列出生成的图片文件
-    image_files = list(images_dir.glob("*.png")) + list(images_dir.glob("*.jpg"))
+    image_files = list_files(images_dir, ('.png', '.jpg'))
     if image_files:
-        print(f"\n🖼️  提取的图片文件 ({len(image_files)} 个):")
+        log.info("\n🖼️  提取的图片文件 (%d 个):", len(image_files))
         for image_file in sorted(image_files):
-            print(f"  - {image_file.name}")
+            log.info("  - %s", image_file.name)
+    flush_logging()
 
 if __name__ == "__main__":
     batch_process_annotated_documents()
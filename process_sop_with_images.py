@@ -7,26 +7,158 @@ SOP文档智能解析脚本 - 集成图片处理版本
 
 import sys
 import re
+import csv
+import bisect
 import json
-import pandas as pd
+import logging
 import os
 import shutil
-from collections import defaultdict
-from typing import List, Dict, Tuple
+from collections import defaultdict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional
 from docx import Document
 from docx.table import Table
 from docx.text.paragraph import Paragraph
-from docx.oxml.table import CT_Tbl
+from docx.oxml.table import CT_Tbl, CT_Tc
 from docx.oxml.text.paragraph import CT_P
 from docx.oxml import OxmlElement
-from docx.oxml.ns import qn
+from docx.oxml.ns import qn, nsmap
 from docx.oxml import parse_xml
+from lxml import etree
+
+# 逐图片的归属明细只在DEBUG级别输出（默认不格式化、不写stdout），汇总信息仍直接print
+log = logging.getLogger("sop.process")
+
+
+# 标题识别相关的预编译正则
+_H_STYLE_RE = re.compile(r'^H(\d+)$')  # 简写样式名：H1/H2/H3...
+_HEADING_STYLE_LEVEL_RE = re.compile(r'Heading\s*(\d+)')
+_CN_HEADING_STYLE_LEVEL_RE = re.compile(r'标题\s*(\d+)')
+# 行首编号分类（一次匹配）：multi=多级编号(3.1)，paren=单级括号编号(4))，dot=单级点号编号(5.)
+_HEADING_NUMBER_RE = re.compile(r'^(?:(?P<multi>\d+(?:\.\d+)+)|(?P<paren>\d+\))|(?P<dot>\d+\.))')
+_NUM_PREFIX_RE = re.compile(r'^\d+(?:\.\d+)*[\.\)]\s*')
+
+_LEADING_NUMBER_RE = re.compile(r'^(\d+(?:\.\d+)*)')  # 标题前的显式编号(如 5.1)
+_DOTTED_NUMBER_RE = re.compile(r'(\d+\.\d+)')  # caption中的小节编号(如 5.3)
+_LEADING_DIGIT_RE = re.compile(r'^\d')
+
+# 文件名/图片ID解析
+_SOP_ID_RE = re.compile(r'^([A-Z0-9\.\-]+)')  # 文件名开头的SOP ID
+_IMAGE_ID_NUM_RE = re.compile(r'image_?(\d+)')
+
+# 图片caption相关的预编译正则
+_CAPTION_PREFIX_RE = re.compile(r'^(图表|图|Figure|Fig)[\s：:]*\d+')
+_CAPTION_LABEL_RE = re.compile(r'^图表\s*\d+[\s：:]*')
+_WHITESPACE_RE = re.compile(r'\s+')
+_FIGURE_LINE_RE = re.compile(r'^(图表|图|Figure|Fig)\s*\d+')  # 以图表编号开头的caption行
+_IMG_BLOCK_RE = re.compile(r"\[图: ([^\]]*)\]")  # chunk中的标准图片输出块，分组为方括号内全部内容
+
+# 文本中的图片引用模式（合并为单个正则，一次扫描）
+_IMG_REF_RE = re.compile('|'.join((
+    r'图\s*\d+',  # 图1, 图 1
+    r'图片\s*\d+',  # 图片1, 图片 1
+    r'附图\s*\d+',  # 附图1, 附图 1
+    r'Figure\s*\d+',  # Figure 1
+    r'Fig\s*\d+',  # Fig 1
+    r'见下图',  # 见下图
+    r'如图所示',  # 如图所示
+    r'参考图',  # 参考图
+)), re.IGNORECASE)
+
+# 标题关键词 - 只识别明确的标题关键词
+_TOP_LEVEL_KEYWORDS = frozenset({
+    "目的", "适用范围", "安全和环境要求", "相关文件", "职责",
+    "定义和缩写", "活动描叙", "具体操作如下", "附录", "历史纪录"
+})
+# 带数字编号时可判定为标题的关键词（子串匹配）
+_TITLE_KEYWORDS = (
+    "目的", "适用范围", "职责", "活动描述", "相关文件", "定义",
+    "附录", "历史", "记录", "规程", "说明", "注意事项"
+)
+_TITLE_KEYWORDS_RE = re.compile('|'.join(map(re.escape, _TITLE_KEYWORDS)))
+# 表格可直接归属的顶级章节
+_TOP_LEVEL_TABLE_SECTIONS = frozenset({
+    "3.1 风险识别", "3.2 关键控制点", "5.职责", "6.定义和缩写", "8.历史文件记录"
+})
+
+# 表格内容特征 -> 归属章节（按顺序匹配，所有关键词都出现才命中）
+# 通用RACI职责矩阵不再强制映射到固定章节，优先以文档当前位置归属
+_TABLE_SECTION_RULES = (
+    (("分类", "危险源", "控制措施"), "3.1 风险识别"),
+    (("相关模块", "危险源", "控制措施"), "3.2 关键控制点"),
+    (("成品库保管员", "成品库班长", "SOP撰写"), "5.职责"),
+    (("本SOP涉及到的主要KPI", "PI"), "6.定义和缩写"),
+    (("版本", "作者", "日期"), "8.历史文件记录"),
+    (("仓库利用率", "劳动生产率"), "6.定义和缩写"),
+    (("PPE矩阵", "风险评估"), "3.2 关键控制点"),
+    (("应急方案", "成品酒高空坠落"), "3.2 关键控制点"),
+)
+
+# 隔离相关图片的固定归属章节（7.4.3）
+_SEC_743 = ("7.活动描述 > 7.4不合格品管理 > 7.4.3当班班长接收隔离完成后，当班邮件反馈隔离信息，通知QA人员现场张贴隔离单，"
+            "QA邮件反馈隔离信息；（隔离单上应包含隔离数量、品种、批次，隔离原因及隔离人，严格执行隔离四要素；"
+            "隔离四要素请参考《隔离酒OPL》及《品质隔离标准VPO QUAL WH 3 4 1 002 隔离酒操作.docx》；")
+
+# 图片caption关键词 -> 归属章节（按顺序匹配第一条命中的规则）
+# 每条规则: (任一出现即命中的关键词, 需同时出现才命中的关键词, chunk章节路径需包含的任一子串)
+_CAPTION_KEYWORD_RULES = (
+    (("配送模式",), (), ("9.配送模式",)),
+    (("自提模式",), (), ("10. 自提模式", "自提模式")),
+    (("非百威瓶", "破损瓶"), ("外观", "瓶外壁"), ("5.1可接收-普通洗瓶工艺能洗净",)),  # 5.1章节的特殊匹配
+    (("霉斑", "磨花", "特脏", "破损", "不干胶", "塑料标签", "瓶口缺陷", "假标签", "喷码", "标签"), (),
+     ("5.3不可接收-不合格",)),
+    (("塑箱", "铁丝", "焊接"), (), ("5.4不可接收的回收塑箱",)),
+    (("扎啤桶", "改装", "变形", "瓶阀"), (), ("5.5不可接收的扎啤桶",)),
+)
+
+# 段落内图片关系ID的预编译XPath（仅覆盖段落的直接 w:r 子节点，与 paragraph.runs 一致）
+# 并集查询按文档顺序返回结果，与逐个run依次取 blip、imagedata 的顺序相同
+_IMAGE_REL_IDS_XPATH = etree.XPath(
+    './w:r//a:blip/@r:embed | ./w:r//*[local-name()="imagedata"]/@r:id',
+    namespaces=nsmap)
+
+
+def get_image_rel_ids(paragraph: Paragraph) -> List[str]:
+    """一次XPath查询返回段落中所有图片的关系ID（drawing blip 与 pict imagedata），按出现顺序"""
+    return [str(rid) for rid in _IMAGE_REL_IDS_XPATH(paragraph._element) if rid]
+
+
+# 图片扩展名映射（小写后缀 -> 输出扩展名）
+_EXT_MAP = {'.png': '.png', '.jpg': '.jpg', '.jpeg': '.jpg', '.gif': '.gif', '.bmp': '.bmp'}
+
+# 列表符号规范化：行首的 ·/• 、 --<Tab> 、 、 统一替换为 Markdown 列表符号
+_LIST_SYMBOL_RE = re.compile(r'^(?:[·•]\s*|--\t|、\s*)', re.MULTILINE)
+
+
+class Chunk:
+    """
+    知识块（每个小节文本或表格一条），使用__slots__降低大批量chunk的内存占用
+    手写__slots__而非 @dataclass(slots=True)，后者需要Python 3.10+
+    """
+    __slots__ = ('chunk', 'sop_id', 'sop_name', 'section_path', 'image_filename', 'image_section_path')
+
+    def __init__(self, chunk: str, sop_id: str, sop_name: str, section_path: str,
+                 image_filename: str = '', image_section_path: str = ''):
+        self.chunk = chunk
+        self.sop_id = sop_id
+        self.sop_name = sop_name
+        self.section_path = section_path
+        self.image_filename = image_filename
+        self.image_section_path = image_section_path
+
+
+def _write_blob(item: Tuple[str, bytes]) -> None:
+    """将图片数据写入指定路径（供线程池调用）"""
+    image_path, image_data = item
+    with open(image_path, 'wb') as f:
+        f.write(image_data)
 
 
 def iter_block_items(doc: Document):
     """
     按文档实际顺序依次返回段落和表格。
-    用于在不改动主处理流程的情况下，预先为表格记录其出现位置对应的最近标题路径。
+    主流程据此单次遍历正文：同时切分小节、生成表格chunk，并记录每个段落/表格出现位置对应的最近标题路径。
     """
     for child in doc.element.body.iterchildren():
         if isinstance(child, CT_P):
@@ -34,44 +166,62 @@ def iter_block_items(doc: Document):
         elif isinstance(child, CT_Tbl):
             yield Table(child, doc)
 
-def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "sop_images") -> Dict[str, Dict[str, str]]:
+def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "sop_images",
+                                           doc: Optional[Document] = None) -> Dict[str, Dict[str, str]]:
     """
     从Word文档中提取图片及其caption信息并保存到指定目录
     
     参数:
         docx_path: Word文档路径
         output_dir: 图片输出目录
+        doc: 已打开的Word文档（可选，传入时不再重复解析docx_path）
         
     返回:
         图片信息字典 {图片ID: {"filename": 图片文件名, "caption": 图片标题}}
     """
-    # 创建输出目录
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    # 创建输出目录（已存在时不报错）
+    os.makedirs(output_dir, exist_ok=True)
     
     # 获取文档名称（不含扩展名）
     doc_name = os.path.splitext(os.path.basename(docx_path))[0]
     
     # 打开Word文档
-    doc = Document(docx_path)
+    if doc is None:
+        doc = Document(docx_path)
+    
+    # 段落列表与段落文本只读取一次（doc.paragraphs 每次访问都会重建列表）
+    paragraphs = doc.paragraphs
+    para_texts = [p.text.strip() for p in paragraphs]
+    heading_flags: Dict[int, bool] = {}  # 段落索引 -> 是否为标题（按需计算并缓存）
+    style_names: Dict[Optional[str], str] = {}  # 样式ID -> 样式名
+
+    def _is_heading_at(j: int) -> bool:
+        if j not in heading_flags:
+            try:
+                heading_flags[j] = classify_heading(paragraphs[j], para_texts[j],
+                                                    get_style_name(paragraphs[j], style_names)) is not None
+            except Exception:
+                heading_flags[j] = False
+        return heading_flags[j]
     
     # 图片信息字典
     image_info = {}
     image_counter = 1
+    image_writes: List[Tuple[str, bytes]] = []  # 待写入的 (图片路径, 图片数据)
     
-    # 定义caption判定
-    def _is_caption_text(t: str) -> bool:
+    # 定义caption判定：返回 (是否可作caption, 是否带"图表/图/Figure/Fig+编号"前缀)
+    # para_texts 已去除首尾空白，前缀正则只需匹配一次，评分时直接复用结果
+    def _check_caption(t: str) -> Tuple[bool, bool]:
         if not t:
-            return False
-        if re.match(r'^(图表|图|Figure|Fig)[\s：:]*\d+', t.strip()):
-            return True
-        return len(t.strip()) <= 120
+            return False, False
+        if _CAPTION_PREFIX_RE.match(t):
+            return True, True
+        return len(t) <= 120, False
 
     # 预收集所有可能的caption段落，供后续兜底匹配
     all_caption_paras = []  # [(idx, text)]
-    for _ci, _p in enumerate(Document(docx_path).paragraphs):
-        _t = _p.text.strip()
-        if _is_caption_text(_t):
+    for _ci, _t in enumerate(para_texts):
+        if _check_caption(_t)[0]:
             all_caption_paras.append((_ci, _t))
 
     # 首先处理表格中的图片
@@ -80,32 +230,10 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
         for row_idx, row in enumerate(table.rows):
             for cell_idx, cell in enumerate(row.cells):
                 for para_idx, paragraph in enumerate(cell.paragraphs):
-                    # 检查段落是否包含图片
-                    has_image = False
-                    image_rel_id = None
-                    
-                    for run in paragraph.runs:
-                        # 查找图片关系ID（drawing blip）
-                        for drawing in run._element.xpath('.//a:blip'):
-                            # 获取图片关系ID
-                            embed_id = drawing.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                            if embed_id:
-                                image_rel_id = embed_id
-                                has_image = True
-                                break
-                        
-                        # 查找图片关系ID（pict imagedata）
-                        if not has_image:
-                            for imagedata in run._element.xpath('.//*[local-name()="imagedata"]'):
-                                # 获取图片关系ID
-                                embed_id = imagedata.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id')
-                                if embed_id:
-                                    image_rel_id = embed_id
-                                    has_image = True
-                                    break
-                        
-                        if has_image:
-                            break
+                    # 检查段落是否包含图片（取第一张）
+                    rel_ids = get_image_rel_ids(paragraph)
+                    has_image = bool(rel_ids)
+                    image_rel_id = rel_ids[0] if rel_ids else None
                     
                     if has_image and image_rel_id:
                         # 查找图片的caption（在表格单元格中）
@@ -131,35 +259,18 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
                                 caption_index = f"table_{table_idx}_row_{row_idx}_cell_{cell_idx}_para_{para_idx-1}"
                         
                         # 根据关系ID找到对应的图片关系
-                        target_rel = None
-                        for rel in doc.part.rels.values():
-                            if rel.rId == image_rel_id:
-                                target_rel = rel
-                                break
+                        target_rel = doc.part.rels.get(image_rel_id)
                         
                         if target_rel and "image" in target_rel.target_ref:
-                            # 获取图片数据
-                            image_data = target_rel.target_part.blob
-                            
-                            # 确定图片扩展名
-                            if target_rel.target_ref.endswith('.png'):
-                                ext = '.png'
-                            elif target_rel.target_ref.endswith('.jpg') or target_rel.target_ref.endswith('.jpeg'):
-                                ext = '.jpg'
-                            elif target_rel.target_ref.endswith('.gif'):
-                                ext = '.gif'
-                            elif target_rel.target_ref.endswith('.bmp'):
-                                ext = '.bmp'
-                            else:
-                                ext = '.png'  # 默认扩展名
+                            # 确定图片扩展名（不区分大小写，未知类型默认.png）
+                            ext = _EXT_MAP.get(os.path.splitext(target_rel.target_ref)[1].lower(), '.png')
                             
                             # 生成图片文件名，添加image_id前缀
                             image_filename = f"{doc_name}_image_id____image{image_counter}{ext}"
                             image_path = os.path.join(output_dir, image_filename)
                             
-                            # 保存图片
-                            with open(image_path, 'wb') as f:
-                                f.write(image_data)
+                            # 保存图片（先收集，最后统一并发写入）
+                            image_writes.append((image_path, target_rel.target_part.blob))
                             
                             # 记录图片信息
                             image_info[f"image_{image_counter}"] = {
@@ -181,24 +292,11 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
     print(f"从表格中提取了 {table_image_counter} 张图片")
 
     # 遍历文档中的所有段落，查找图片和其caption
-    for i, paragraph in enumerate(doc.paragraphs):
+    for i, paragraph in enumerate(paragraphs):
         # 检查段落是否包含图片 - 修复：处理同一段落中的多张图片
-        image_rel_ids = []
-        
-        for run in paragraph.runs:
-            # 查找图片关系ID（drawing blip）
-            for drawing in run._element.xpath('.//a:blip'):
-                # 获取图片关系ID
-                embed_id = drawing.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                if embed_id:
-                    image_rel_ids.append(embed_id)
-            
-            # 查找图片关系ID（pict imagedata）
-            for imagedata in run._element.xpath('.//*[local-name()="imagedata"]'):
-                # 获取图片关系ID
-                embed_id = imagedata.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id')
-                if embed_id:
-                    image_rel_ids.append(embed_id)
+        image_rel_ids = get_image_rel_ids(paragraph)
+        if not image_rel_ids:
+            continue
         
         # 处理该段落中的所有图片
         for image_rel_id in image_rel_ids:
@@ -206,32 +304,27 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
             caption = ""
             caption_index = None  # 记录caption所在段落索引，用于基于位置的强制归属
 
-            def is_caption_text(t: str) -> bool:
-                return _is_caption_text(t)
-
             # 候选列表：[(text, idx, score)] 分数高者优先
             candidates = []
 
-            cur_text = paragraph.text.strip()
+            cur_text = para_texts[i]
             if cur_text:
-                score = 2 if re.match(r'^(图表|图|Figure|Fig)[\s：:]*\d+', cur_text) else 1
+                score = 2 if _CAPTION_PREFIX_RE.match(cur_text) else 1
                 candidates.append((cur_text, i, score))
 
             # 向后最多前瞻8段（处理"caption在后"），遇到标题提前停止，优先检查后面的段落
             for offset in range(1, 9):
                 j = i + offset
-                if j >= len(doc.paragraphs):
+                if j >= len(paragraphs):
                     break
-                t = doc.paragraphs[j].text.strip()
+                t = para_texts[j]
                 if not t:
                     continue
-                try:
-                    if is_heading_paragraph(doc.paragraphs[j]):
-                        break
-                except Exception:
-                    pass
-                if is_caption_text(t):
-                    score = 4 if re.match(r'^(图表|图|Figure|Fig)[\s：:]*\d+', t) else 2  # 后面的图表caption优先级更高
+                if _is_heading_at(j):
+                    break
+                ok, has_prefix = _check_caption(t)
+                if ok:
+                    score = 4 if has_prefix else 2  # 后面的图表caption优先级更高
                     candidates.append((t, j, score))
 
             # 向前最多回溯8段，遇到标题行提前停止；优先"图表"前缀
@@ -240,17 +333,15 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
                 j = i - offset
                 if j < 0:
                     break
-                t = doc.paragraphs[j].text.strip()
+                t = para_texts[j]
                 if not t:
                     continue
                 # 碰到标题则停止继续回溯
-                try:
-                    if is_heading_paragraph(doc.paragraphs[j]):
-                        break
-                except Exception:
-                    pass
-                if is_caption_text(t):
-                    score = 3 if re.match(r'^(图表|图|Figure|Fig)[\s：:]*\d+', t) else 1
+                if _is_heading_at(j):
+                    break
+                ok, has_prefix = _check_caption(t)
+                if ok:
+                    score = 3 if has_prefix else 1
                     candidates.append((t, j, score))
 
             # 读取图片 alt 文本（docPr title/descr）作为候选
@@ -275,50 +366,33 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
                 caption_index = None
                 
                 # 检查后一段落
-                if i + 1 < len(doc.paragraphs):
-                    next_text = doc.paragraphs[i + 1].text.strip()
+                if i + 1 < len(paragraphs):
+                    next_text = para_texts[i + 1]
                     if next_text:
                         caption = next_text
                         caption_index = i + 1
                 
                 # 如果后一段落没有，检查前一段落
                 if not caption and i > 0:
-                    prev_text = doc.paragraphs[i - 1].text.strip()
+                    prev_text = para_texts[i - 1]
                     if prev_text:
                         caption = prev_text
                         caption_index = i - 1
                 
             
             # 根据关系ID找到对应的图片关系
-            target_rel = None
-            for rel in doc.part.rels.values():
-                if rel.rId == image_rel_id:
-                    target_rel = rel
-                    break
+            target_rel = doc.part.rels.get(image_rel_id)
             
             if target_rel and "image" in target_rel.target_ref:
-                # 获取图片数据
-                image_data = target_rel.target_part.blob
-                
-                # 确定图片扩展名
-                if target_rel.target_ref.endswith('.png'):
-                    ext = '.png'
-                elif target_rel.target_ref.endswith('.jpg') or target_rel.target_ref.endswith('.jpeg'):
-                    ext = '.jpg'
-                elif target_rel.target_ref.endswith('.gif'):
-                    ext = '.gif'
-                elif target_rel.target_ref.endswith('.bmp'):
-                    ext = '.bmp'
-                else:
-                    ext = '.png'  # 默认扩展名
+                # 确定图片扩展名（不区分大小写，未知类型默认.png）
+                ext = _EXT_MAP.get(os.path.splitext(target_rel.target_ref)[1].lower(), '.png')
                 
                 # 生成图片文件名，添加image_id前缀
                 image_filename = f"{doc_name}_image_id____image{image_counter}{ext}"
                 image_path = os.path.join(output_dir, image_filename)
                 
-                # 保存图片
-                with open(image_path, 'wb') as f:
-                    f.write(image_data)
+                # 保存图片（先收集，最后统一并发写入）
+                image_writes.append((image_path, target_rel.target_part.blob))
                 
                 # 记录图片信息
                 image_info[f"image_{image_counter}"] = {
@@ -334,32 +408,39 @@ def extract_images_with_captions_from_docx(docx_path: str, output_dir: str = "so
                 
                 image_counter += 1
     
-    # 二次兜底：对未识别caption的图片，按最近“图表/图/Fig/Figure+数字”段落就近匹配
-    if image_info:
+    # 图片写盘是纯I/O（写入时释放GIL），用线程池并发写出所有图片
+    if image_writes:
+        with ThreadPoolExecutor(max_workers=min(8, len(image_writes))) as executor:
+            list(executor.map(_write_blob, image_writes))
+
+    # 二次兜底：对未识别caption的图片，按最近“图表/图/Fig/Figure+数字”段落就近匹配（无候选caption段落时无需处理）
+    if image_info and all_caption_paras:
         items = []  # [(img_idx, para_idx, id_key)]
         for k, v in image_info.items():
             items.append((int(k.split('_')[1]), v.get('para_index', -1), k))
         items.sort()
+        # caption段落已按段落顺序排列，用二分查找定位图片前后最近的caption段
+        caption_indices = [ci for ci, _ in all_caption_paras]
         # 逐个未命中的寻找最近caption段
         for _, para_idx, key in items:
             if image_info[key].get('caption'):
                 continue
             best = None
-            best_dist = 10**9
-            for (ci, txt) in all_caption_paras:
-                # 处理表格图片的特殊情况
-                if isinstance(para_idx, str) and para_idx.startswith('table_'):
-                    # 对于表格图片，跳过距离计算，直接使用第一个可用的caption
-                    best = (ci, txt)
-                    break
-                else:
-                    # 普通段落图片的处理
-                    dist = abs(ci - para_idx)
-                    if ci <= para_idx:  # 优先前面的caption
-                        dist -= 0.1
-                    if dist < best_dist:
-                        best_dist = dist
-                        best = (ci, txt)
+            # 处理表格图片的特殊情况
+            if isinstance(para_idx, str) and para_idx.startswith('table_'):
+                # 对于表格图片，跳过距离计算，直接使用第一个可用的caption
+                best = all_caption_paras[0]
+            else:
+                # 普通段落图片的处理：k-1 为前面(含当前段)最近的caption，k 为后面最近的caption
+                k = bisect.bisect_right(caption_indices, para_idx)
+                has_prev = k > 0
+                has_next = k < len(caption_indices)
+                # 优先前面的caption：距离不超过后面的caption时选前面的
+                if has_prev and (not has_next or
+                                 para_idx - caption_indices[k - 1] <= caption_indices[k] - para_idx):
+                    best = all_caption_paras[k - 1]
+                elif has_next:
+                    best = all_caption_paras[k]
             if best:
                 image_info[key]['caption'] = best[1]
                 image_info[key]['caption_index'] = best[0]
@@ -383,10 +464,9 @@ def create_enhanced_image_chunk_content(filename: str, target_section: str, capt
     clean_caption = ""
     if caption:
         # 1) 去掉“图表 数字 + 冒号(可选)”前缀  2) 去掉多余空白
-        import re
-        tmp = re.sub(r'^图表\s*\d+[\s：:]*', '', caption).strip()
+        tmp = _CAPTION_LABEL_RE.sub('', caption).strip()
         # 3) 归一化空白
-        tmp = re.sub(r'\s+', ' ', tmp)
+        tmp = _WHITESPACE_RE.sub(' ', tmp)
         clean_caption = f"图片内容：{tmp}" if tmp else ""
     
     # 构建增强的chunk内容（按用户要求：文件名与图片内容都在同一对中括号内，换行分隔）
@@ -406,206 +486,176 @@ def find_image_references_in_text(text: str) -> List[str]:
         text: 文本内容
         
     返回:
-        图片引用列表
+        图片引用列表（按出现顺序，互不重叠）
     """
-    # 查找可能的图片引用模式
-    image_patterns = [
-        r'图\s*\d+',  # 图1, 图 1
-        r'图片\s*\d+',  # 图片1, 图片 1
-        r'附图\s*\d+',  # 附图1, 附图 1
-        r'Figure\s*\d+',  # Figure 1
-        r'Fig\s*\d+',  # Fig 1
-        r'见下图',  # 见下图
-        r'如图所示',  # 如图所示
-        r'参考图',  # 参考图
-    ]
-    
-    references = []
-    for pattern in image_patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        references.extend(matches)
-    
-    return references
+    return _IMG_REF_RE.findall(text)
 
 
-def is_heading_paragraph(paragraph: Paragraph) -> bool:
+def get_style_name(paragraph: Paragraph, cache: Dict[Optional[str], str]) -> str:
     """
-    判断段落是否为标题
-    只识别真正的标题，其他所有文本都作为普通文本处理
+    获取段落样式名，按样式ID缓存（同一文档内样式ID到样式名的映射固定）
+    paragraph.style 每次都要在styles.xml中查找样式，文档中大部分段落共用少数几种样式
     """
-    # 第一优先级：检查Word样式
-    style_name = paragraph.style.name
-    if 'Heading' in style_name or '标题' in style_name:
-        return True
-    # 兼容简写样式名：H1/H2/H3...
-    if re.match(r'^H\d+$', style_name):
-        return True
-    
-    text = paragraph.text.strip()
-    
-    # 第二优先级：检查多级数字编号 (如 3.1, 8.2.1)
-    if re.match(r'^\d+(?:\.\d+)+', text):
-        return True
-    
-    # 第三优先级：检查单级数字编号 (如 4), 5))
-    if re.match(r'^\d+\)', text):
-        return True
-    
-    # 第四优先级：检查关键词 - 只识别明确的标题关键词
-    TOP_LEVEL_KEYWORDS = [
-        "目的", "适用范围", "安全和环境要求", "相关文件", "职责", 
-        "定义和缩写", "活动描叙", "具体操作如下", "附录", "历史纪录"
-    ]
-    
-    # 清理文本前的编号
-    clean_text = re.sub(r'^\d+(?:\.\d+)*[\.\)]\s*', '', text).strip()
-    if clean_text in TOP_LEVEL_KEYWORDS:
-        return True
-    
-    # 如果文本没有数字编号但包含关键词，不是标题（需要数字编号）
-    if not re.match(r'^\d+', text) and clean_text in TOP_LEVEL_KEYWORDS:
-        return False
-    
-    # 特殊处理：检查是否包含"活动描述"关键词
-    if "活动描述" in text and re.match(r'^\d+\.', text):
-        return True
-    
-    # 更精确的标题识别：只匹配明确的标题模式（兼容有无空格）
-    if re.match(r'^\d+\.\s*', text):
-        # 只检查明确的标题关键词，不包括描述性词汇
-        title_keywords = [
-            "目的", "适用范围", "职责", "活动描述", "相关文件", "定义", 
-            "附录", "历史", "记录", "规程", "说明", "注意事项"
-        ]
-        # 如果包含标题关键词，则认为是标题
-        if any(keyword in clean_text for keyword in title_keywords):
-            return True
-    
-    return False
+    style_id = paragraph._p.style
+    name = cache.get(style_id)
+    if name is None:
+        name = cache[style_id] = sys.intern(paragraph.style.name)
+    return name
 
 
-def get_heading_level(paragraph: Paragraph) -> int:
+def classify_heading(paragraph: Paragraph, text: Optional[str] = None,
+                     style_name: Optional[str] = None) -> Optional[int]:
     """
-    获取标题的层级
+    判断段落是否为标题并同时给出层级，非标题返回None
+    只识别真正的标题，其他所有文本都作为普通文本处理；编号正则只匹配一次，分类与层级共用结果
+    text/style_name 可传入调用方已取得的段落文本（已strip）和样式名，避免重复读取XML
     """
-    # 第一优先级：检查Word样式
-    style_name = paragraph.style.name
+    # 第一优先级：检查Word样式（样式名中带层级时直接返回）
+    if style_name is None:
+        style_name = paragraph.style.name
     if 'Heading' in style_name:
-        match = re.search(r'Heading\s*(\d+)', style_name)
+        match = _HEADING_STYLE_LEVEL_RE.search(style_name)
         if match:
             return int(match.group(1))
+        styled = True
     elif '标题' in style_name:
-        match = re.search(r'标题\s*(\d+)', style_name)
+        match = _CN_HEADING_STYLE_LEVEL_RE.search(style_name)
         if match:
             return int(match.group(1))
+        styled = True
     else:
-        # 兼容H1/H2/H3样式
-        m = re.match(r'^H(\d+)$', style_name)
-        if m:
-            return int(m.group(1))
-    
-    # 第二优先级：检查数字编号
-    text = paragraph.text.strip()
-    
-    # 多级数字编号 (如 3.1, 8.2.1)
-    match = re.match(r'^(\d+(?:\.\d+)+)', text)
-    if match:
-        level = match.group(1).count('.') + 1
-        return min(level, 10)  # 限制最大层级为10
-    
-    # 单级数字编号 (如 4), 5))
-    if re.match(r'^\d+\)', text):
-        return 1
-    
-    # 纯数字标题 (如 8.历史文件记录)
-    if re.match(r'^\d+\.\s*', text):
+        # 兼容简写样式名：H1/H2/H3...
+        match = _H_STYLE_RE.match(style_name)
+        if match:
+            return int(match.group(1))
+        styled = False
+    
+    if text is None:
+        text = paragraph.text.strip()
+    match = _HEADING_NUMBER_RE.match(text)
+    kind = match.lastgroup if match else None
+    
+    # 第二优先级：多级数字编号 (如 3.1, 8.2.1)，层级为点号数+1
+    if kind == 'multi':
+        return min(match.group('multi').count('.') + 1, 10)  # 限制最大层级为10
+    # 其余标题均为一级：单级括号编号 (如 4), 5))、带样式但无层级、关键词标题
+    if styled or kind == 'paren':
         return 1
     
-    # 第三优先级：检查关键词
-    TOP_LEVEL_KEYWORDS = [
-        "目的", "适用范围", "安全和环境要求", "环境和安全说明", "相关文件", "职责", 
-        "定义和缩写", "活动描叙", "具体操作如下", "附录", "历史纪录"
-    ]
-    
+    # 第三优先级：检查关键词 - 只识别明确的标题关键词（空段落只能通过样式成为标题）
+    if not text:
+        return None
     # 清理文本前的编号
-    clean_text = re.sub(r'^\d+(?:\.\d+)*[\.\)]\s*', '', text).strip()
-    if clean_text in TOP_LEVEL_KEYWORDS:
+    clean_text = _NUM_PREFIX_RE.sub('', text).strip()
+    if clean_text in _TOP_LEVEL_KEYWORDS:
         return 1
     
-    # 特殊处理：检查是否包含"活动描述"关键词
-    if "活动描述" in text and re.match(r'^\d+\.', text):
-        return 1
+    # 更精确的标题识别：只匹配明确的标题模式（兼容有无空格）
+    if kind == 'dot':
+        # 特殊处理：包含"活动描述"关键词；或包含明确的标题关键词（不包括描述性词汇）
+        if "活动描述" in text or _TITLE_KEYWORDS_RE.search(clean_text):
+            return 1
     
-    return 1  # 默认层级
+    return None
+
+
+@lru_cache(maxsize=4096)
+def parse_leading_number(text: str) -> Optional[Tuple[int, ...]]:
+    """
+    解析标题开头的显式编号（如 "5.1 成品酒入库检查" -> (5, 1)），无编号返回None
+    同一标题会被位置标题栈与主流程标题栈各解析一次，结果按文本缓存
+    """
+    number_match = _LEADING_NUMBER_RE.match(text)
+    if number_match:
+        return tuple(int(n) for n in number_match.group(1).split('.'))
+    return None
+
+
+def _renumber(h_text: str, h_level: int, counters: List[int]) -> Tuple[str, List[int]]:
+    """
+    计算标题的编号文本：显式编号(如 5.1)优先并同步计数器，否则按层级自动编号
+    返回 (编号后的标题文本, 新的计数器)，不修改传入的计数器
+    """
+    explicit_number = parse_leading_number(h_text)
+    if explicit_number is not None:
+        # 同步计数器为显式编号
+        return h_text, list(explicit_number)
+    # 确保计数器长度与层级一致，当前层级自增，深层级清零隐含在截断中
+    counters = counters[:h_level] + [0] * (h_level - len(counters))
+    if not counters:
+        counters = [1]
+    else:
+        counters[-1] += 1
+    number_str = '.'.join(str(x) for x in counters)
+    # 规范化标题展示：数字与标题之间加空格（如 1. 目的 / 5.1 成品酒入库检查）
+    if not h_text:
+        return number_str + ('.' if h_level == 1 else ''), counters
+    if h_level == 1:
+        return f"{number_str}. {h_text}", counters
+    return f"{number_str} {h_text}", counters
+
+
+def _starts_with_numeric_heading(line: str) -> bool:
+    r"""
+    判断chunk首行（已strip、不含换行）是否为数字标题
+    与原正则 ^\d+(?:\.\d+)*(?:\.)?\s*.+ 等价：回溯后它只要求以数字开头且之后至少还有一个字符
+    """
+    return len(line) > 1 and line[0].isdecimal()
 
 
 def table_to_markdown(table: Table) -> str:
     """
     将Word表格转换为Markdown格式
     """
-    if not table.rows:
+    # 一次性取出所有单元格文本（cell.text 每次访问都会遍历段落和run）
+    # 合并单元格在 row.cells 中会重复出现（横向合并为同一 w:tc，纵向合并指向首行的 w:tc），
+    # 按 w:tc 元素缓存文本，每个物理单元格只读取一次
+    tc_texts: Dict[CT_Tc, str] = {}
+    rows_text = []
+    for row in table.rows:
+        cells_text = []
+        for cell in row.cells:
+            tc = cell._tc
+            cell_text = tc_texts.get(tc)
+            if cell_text is None:
+                cell_text = tc_texts[tc] = cell.text.strip()
+            cells_text.append(cell_text)
+        rows_text.append(cells_text)
+    if not rows_text:
         return ""
     
-    markdown_lines = []
-    
-    # 处理表头
-    header_row = table.rows[0]
-    header_cells = [cell.text.strip() for cell in header_row.cells]
-    markdown_lines.append("| " + " | ".join(header_cells) + " |")
-    markdown_lines.append("| " + " | ".join(["---"] * len(header_cells)) + " |")
-    
-    # 处理数据行
-    for row in table.rows[1:]:
-        cells = [cell.text.strip() for cell in row.cells]
-        markdown_lines.append("| " + " | ".join(cells) + " |")
-    
-    return "\n".join(markdown_lines)
+    # 表头 + 分隔行 + 数据行
+    header_sep = "| " + " | ".join(["---"] * len(rows_text[0])) + " |"
+    lines = ["| " + " | ".join(cells) + " |" for cells in rows_text]
+    lines.insert(1, header_sep)
+    return "\n".join(lines)
 
 
 def normalize_list_symbols(text: str) -> str:
     """
     将非标准的列表符号替换为标准的Markdown格式
     """
-    # 替换各种非标准列表符号
-    text = re.sub(r'^[·•]\s*', '* ', text, flags=re.MULTILINE)
-    text = re.sub(r'^--\t', '* ', text, flags=re.MULTILINE)
-    text = re.sub(r'^、\s*', '* ', text, flags=re.MULTILINE)
-    
-    return text
+    # 替换各种非标准列表符号（单次扫描）
+    return _LIST_SYMBOL_RE.sub('* ', text)
 
 
 def build_section_path(heading_stack: list) -> str:
     """
     构建完整的章节路径
+    路径会被多个chunk与图片归属比较共用，驻留后相同路径为同一对象，相等比较可直接按身份判定
     """
-    return " > ".join(heading_stack)
+    return sys.intern(" > ".join(heading_stack))
 
 
 def identify_table_section(table_content: str) -> str:
     """
     根据表格内容识别表格应该归属的章节
     """
-    # 根据表格内容特征判断归属章节
-    if "分类" in table_content and "危险源" in table_content and "控制措施" in table_content:
-        return "3.1 风险识别"
-    elif "相关模块" in table_content and "危险源" in table_content and "控制措施" in table_content:
-        return "3.2 关键控制点"
-    elif "成品库保管员" in table_content and "成品库班长" in table_content and "SOP撰写" in table_content:
-        return "5.职责"
-    # 通用RACI职责矩阵识别
-    # 不再强制映射RACI矩阵到固定章节，优先以文档当前位置归属
-    elif "本SOP涉及到的主要KPI" in table_content and "PI" in table_content:
-        return "6.定义和缩写"
-    elif "版本" in table_content and "作者" in table_content and "日期" in table_content:
-        return "8.历史文件记录"
-    elif "仓库利用率" in table_content and "劳动生产率" in table_content:
-        return "6.定义和缩写"
-    elif "PPE矩阵" in table_content and "风险评估" in table_content:
-        return "3.2 关键控制点"
-    elif "应急方案" in table_content and "成品酒高空坠落" in table_content:
-        return "3.2 关键控制点"
-    else:
-        return "未知章节"
+    # 根据表格内容特征判断归属章节：按顺序匹配第一条关键词全部命中的规则
+    for keywords, section in _TABLE_SECTION_RULES:
+        if all(keyword in table_content for keyword in keywords):
+            return section
+    return "未知章节"
 
 
 def build_table_section_path(table_section: str, heading_stack: List[str]) -> str:
@@ -613,7 +663,7 @@ def build_table_section_path(table_section: str, heading_stack: List[str]) -> st
     根据表格所属章节构建正确的section_path
     """
     # 如果表格章节是顶级章节，直接返回
-    if table_section in ["3.1 风险识别", "3.2 关键控制点", "5.职责", "6.定义和缩写", "8.历史文件记录"]:
+    if table_section in _TOP_LEVEL_TABLE_SECTIONS:
         return table_section
     
     # 如果是子章节，需要找到对应的父章节
@@ -643,45 +693,35 @@ def identify_image_section(image_content: str, current_section_path: str) -> str
             # 如果当前在7.4章节，但具体是7.4.3，需要构建正确的路径
             return current_section_path.replace("7.4", "7.4.3")
     
-    # 根据当前章节路径和内容特征判断图片归属
-    if "目的" in current_section_path:
-        return current_section_path
-    elif "适用范围" in current_section_path:
-        return current_section_path
-    elif "安全和环境要求" in current_section_path:
-        return current_section_path
-    elif "相关文件" in current_section_path:
-        return current_section_path
-    elif "职责" in current_section_path:
-        return current_section_path
-    elif "定义和缩写" in current_section_path:
-        return current_section_path
-    elif "活动描述" in current_section_path:
-        return current_section_path
-    elif "成品库管理基本规定" in current_section_path:
-        return current_section_path
-    elif "酒龄控制相关" in current_section_path:
-        return current_section_path
-    elif "盘点相关" in current_section_path:
-        return current_section_path
-    elif "不合格品管理" in current_section_path:
-        return current_section_path
-    elif "入库相关" in current_section_path:
-        return current_section_path
-    elif "发货相关" in current_section_path:
-        return current_section_path
-    elif "3PL供应商管理" in current_section_path:
-        return current_section_path
-    else:
-        # 默认返回当前章节路径
-        return current_section_path
+    # 其余情况（目的/适用范围/职责/活动描述/不合格品管理等各章节及默认）均归属当前章节路径
+    return current_section_path
+
+
+def match_caption_rule(caption: str) -> Tuple[Tuple[str, ...], str]:
+    """
+    根据图片caption确定其归属条件，只与caption有关，每张图片计算一次
+    返回 (chunk章节路径需包含的任一子串, chunk章节路径需以其开头的编号)，均为空表示caption无归属线索
+    """
+    # 首先尝试从caption中提取数字前缀（优先级最高）
+    prefix_match = _DOTTED_NUMBER_RE.search(caption)
+    if prefix_match:
+        return (prefix_match.group(1),), ""
+    # 然后尝试根据关键词匹配
+    for any_keywords, all_keywords, sections in _CAPTION_KEYWORD_RULES:
+        if (any(keyword in caption for keyword in any_keywords) or
+                (all_keywords and all(keyword in caption for keyword in all_keywords))):
+            return sections, ""
+    # 如果没有关键词匹配，尝试从caption开头提取数字前缀
+    caption_match = _LEADING_NUMBER_RE.match(caption)
+    if caption_match:
+        return (), caption_match.group(1)
+    return (), ""
 
 
 def process_sop_document_with_images(docx_path: str, output_dir: str = "output") -> list:
     """
     处理SOP文档，返回所有知识块（包含图片处理）
     """
-    import re
     print("=" * 60)
     print("SOP文档智能解析工具 - 集成图片处理版本")
     print("=" * 60)
@@ -691,15 +731,23 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
     images_dir = os.path.join(script_dir, 'sop_images')
     os.makedirs(images_dir, exist_ok=True)
 
+    # 读取Word文档（只解析一次，图片提取与正文处理共用）
+    try:
+        doc = Document(docx_path)
+        print(f"成功读取文档: {docx_path}")
+    except Exception as e:
+        print(f"读取文档失败: {e}")
+        return []
+    
     # 首先提取图片及其caption（固定提取到 sop_images）
     print("正在提取图片及其标题...")
-    image_info = extract_images_with_captions_from_docx(docx_path, images_dir)
+    image_info = extract_images_with_captions_from_docx(docx_path, images_dir, doc)
     
     # 创建按文档顺序排列的图片列表
     ordered_images = []
     for image_id, info in image_info.items():
         # 不再过滤无caption的图片，所有图片都参与处理
-        match = re.search(r'image_?(\d+)', image_id)
+        match = _IMAGE_ID_NUM_RE.search(image_id)
         if match:
             index = int(match.group(1))
             ordered_images.append({
@@ -707,6 +755,7 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
                 'id': image_id,
                 'filename': info['filename'],
                 'caption': info.get('caption', ''),
+                'caption_index': info.get('caption_index'),  # caption所在段落索引（表格图片为字符串位置）
                 'used': False,  # 标记是否已使用
                 'is_table_image': info.get('is_table_image', False),  # 是否为表格图片
                 'table_index': info.get('table_index', -1)  # 表格索引
@@ -734,31 +783,24 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
     # 创建简单的图片映射（向后兼容）
     image_mapping = {img_id: info["filename"] for img_id, info in image_info.items()}
     
-    # 读取Word文档
-    try:
-        doc = Document(docx_path)
-        print(f"成功读取文档: {docx_path}")
-    except Exception as e:
-        print(f"读取文档失败: {e}")
-        return []
-    
     # 初始化变量
     chunks = []
     heading_stack = []  # 维护标题层级栈
+    current_path = ""  # heading_stack 对应的章节路径，仅在标题栈变化时重建
     current_heading_text = ""  # 当前最深层级的标题文本
     table_counter_map = defaultdict(int)  # 为每个标题维护独立的表格计数器
     current_content_buffer = []  # 当前小节的内容缓冲区
     heading_counters: List[int] = []  # 自动编号计数器（按层级维护）
     image_counter = 1  # 图片计数器
     image_section_mapping = {}  # 图片与section_path的映射
-    pending_images = list(image_mapping.values())  # 待分配的图片列表
+    pending_images = deque(image_mapping.values())  # 待分配的图片队列（按顺序从队首取出）
     
     # 从文件名中提取SOP信息
     base_name = os.path.splitext(os.path.basename(docx_path))[0]
     
     # 尝试从文件名中提取SOP ID（格式：VPO.MGT.WH.3.5.4.001成品酒仓库管理）
     # 匹配模式：字母数字点号组合，直到遇到中文字符
-    sop_id_match = re.match(r'^([A-Z0-9\.\-]+)', base_name)
+    sop_id_match = _SOP_ID_RE.match(base_name)
     if sop_id_match:
         sop_id = sop_id_match.group(1)
     else:
@@ -773,200 +815,130 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
             sop_name = base_name
     else:
         sop_name = base_name
+    # 每个chunk都引用同一份SOP ID/名称，驻留一次即可
+    sop_id = sys.intern(sop_id)
+    sop_name = sys.intern(sop_name)
     
     print(f"SOP ID: {sop_id}")
     print(f"SOP名称: {sop_name}")
     
     # 收集图片caption用于判定“图片标题型段落”，避免把它们当作新小节切分
-    caption_set = set()
-    for _img_id, _img in image_info.items():
-        cap = (_img.get("caption") or "").strip()
-        if cap:
-            caption_set.add(cap)
+    # 仅标题段落会查询该集合，查询时复用已strip的段落文本，单次哈希查找即可
+    caption_set = {cap for cap in ((_img.get("caption") or "").strip() for _img in image_info.values()) if cap}
     
-    # 预扫描：按文档出现顺序为每个表格记录"出现时最近的标题路径"
+    # 位置追踪与主流程合并为单次遍历：按文档出现顺序为每个表格记录"出现时最近的标题路径"，
+    # 同时构建段落到章节路径映射（用于基于位置的图片强制归属）。
+    # 位置标题栈包含所有标题（含图片标题型段落），与主流程的标题栈分别维护
     table_position_section: Dict[int, str] = {}
+    style_names: Dict[Optional[str], str] = {}  # 样式ID -> 样式名
+    paragraph_section_map: Dict[int, str] = {}
     temp_heading_stack: List[str] = []
-    temp_counters: List[int] = []  # 预扫描用的编号计数器
+    temp_path = ""  # 位置标题栈对应的路径，仅在标题变化时重建
+    temp_counters: List[int] = []  # 位置标题栈用的编号计数器
     table_index = 0  # 表格索引计数器
-    for block in iter_block_items(doc):
-        if isinstance(block, Paragraph):
-            if is_heading_paragraph(block):
-                h_text = block.text.strip()
-                h_level = get_heading_level(block)
-                # 计算编号（与主流程一致）：显式编号优先，否则自动编号
-                number_match = re.match(r'^(\d+(?:\.\d+)*)', h_text)
-                if number_match:
-                    explicit_numbers = [int(n) for n in number_match.group(1).split('.') if n.isdigit()]
-                    temp_counters = explicit_numbers.copy()
-                    numbered_text = h_text
-                else:
-                    if len(temp_counters) < h_level:
-                        temp_counters += [0] * (h_level - len(temp_counters))
-                    else:
-                        temp_counters = temp_counters[:h_level]
-                    if not temp_counters:
-                        temp_counters = [1]
-                    else:
-                        temp_counters[-1] += 1
-                    number_str = '.'.join(str(x) for x in temp_counters)
-                    if h_level == 1:
-                        numbered_text = f"{number_str}. {h_text}" if not re.match(r'^\d', h_text) else h_text
-                    else:
-                        numbered_text = f"{number_str} {h_text}" if not re.match(r'^\d', h_text) else h_text
-
-                # 同步更新临时标题栈（使用编号后的标题，确保表格位置路径带编号）
-                if temp_heading_stack:
-                    # 移除同级及更深层级
-                    if len(temp_heading_stack) >= h_level:
-                        temp_heading_stack = temp_heading_stack[:h_level-1]
-                temp_heading_stack.append(numbered_text)
-        elif isinstance(block, Table):
-            # 记录该表格在文档中的当前位置路径，使用表格索引作为键
-            table_position_section[table_index] = " > ".join(temp_heading_stack)
-            table_index += 1
+    para_index = 0  # 段落索引（与 doc.paragraphs 下标一致）
+    para_texts: List[str] = []  # 各段落strip后的文本（段落文本只读取一次，后续流程复用）
+    # 表格在遇到时生成chunk，暂存到所在小节的文本chunk落盘之后再写入，保持文档顺序
+    pending_table_chunks = []
+    text_chunks: List[Chunk] = []  # 文本chunk（按文档顺序，由 flush_content_buffer 追加）
+    table_chunks: List[Chunk] = []  # 表格chunk（按文档顺序）
 
-    # 构建段落到章节路径映射（用于基于位置的图片强制归属）
-    paragraph_section_map: Dict[int, str] = {}
-    tmp_stack: List[str] = []
-    tmp_counters: List[int] = []
-    for i, p in enumerate(doc.paragraphs):
-        if is_heading_paragraph(p):
-            h_text = p.text.strip()
-            h_level = get_heading_level(p)
-            number_match = re.match(r'^(\d+(?:\.\d+)*)', h_text)
-            if number_match:
-                explicit_numbers = [int(n) for n in number_match.group(1).split('.') if n.isdigit()]
-                tmp_counters = explicit_numbers.copy()
-                numbered_text = h_text
+    def flush_content_buffer(content_buffer: List[str], section_path: str, is_last: bool) -> None:
+        """
+        将一个小节缓冲的内容合并为文本chunk并分配图片（标题处与文档末尾共用）
+        is_last 为True时（文档最后一个小节）把剩余图片按顺序分配，否则仅在剩余图片不多于2张时分配
+        """
+        combined_text = normalize_list_symbols('\n'.join(content_buffer))
+        # 优先使用chunk首行的数字标题作为section_path，以避免父级错绑
+        if combined_text.strip():
+            first_line = combined_text.split('\n', 1)[0].strip()
+            if _starts_with_numeric_heading(first_line):
+                section_path = first_line
+        
+        # 智能分配图片：优先分配给有图片引用的内容
+        image_filename = ""
+        image_section_path = ""
+        image_refs = find_image_references_in_text(combined_text)
+        
+        # 特殊处理：检查是否应该将图片分配给7.4.3章节
+        should_assign_to_743 = "7.4" in section_path and "隔离" in combined_text  # 先查较短的章节路径
+        
+        if image_refs and pending_images:
+            # 有图片引用，分配第一张待分配图片
+            image_filename = pending_images.popleft()
+            if should_assign_to_743:
+                image_section_path = _SEC_743
             else:
-                if len(tmp_counters) < h_level:
-                    tmp_counters += [0] * (h_level - len(tmp_counters))
-                else:
-                    tmp_counters = tmp_counters[:h_level]
-                if not tmp_counters:
-                    tmp_counters = [1]
-                else:
-                    tmp_counters[-1] += 1
-                number_str = '.'.join(str(x) for x in tmp_counters)
-                if h_level == 1:
-                    numbered_text = f"{number_str}. {h_text}" if not re.match(r'^\d', h_text) else h_text
-                else:
-                    numbered_text = f"{number_str} {h_text}" if not re.match(r'^\d', h_text) else h_text
-            if tmp_stack and len(tmp_stack) >= h_level:
-                tmp_stack = tmp_stack[:h_level-1]
-            tmp_stack.append(numbered_text)
-        paragraph_section_map[i] = " > ".join(tmp_stack)
+                image_section_path = identify_image_section(combined_text, section_path)
+            image_section_mapping[image_filename] = image_section_path
+            log.debug("图片关联: %s -> %s (基于图片引用)", image_filename, image_section_path)
+        elif pending_images and should_assign_to_743:
+            # 特殊处理：将图片分配给7.4.3章节
+            image_filename = pending_images.popleft()
+            image_section_path = _SEC_743
+            image_section_mapping[image_filename] = image_section_path
+            log.debug("图片关联: %s -> %s (特殊分配7.4.3)", image_filename, image_section_path)
+        elif pending_images and (is_last or len(pending_images) <= 2):
+            # 如果图片不多（或已是最后一个小节），按顺序分配给有内容的小节
+            image_filename = pending_images.popleft()
+            image_section_path = identify_image_section(combined_text, section_path)
+            image_section_mapping[image_filename] = image_section_path
+            log.debug("图片关联: %s -> %s (按顺序分配)", image_filename, image_section_path)
+        
+        # 跳过文档开头的总标题等无章节内容（无section_path时不落盘）
+        if section_path:
+            text_chunk = Chunk(
+                chunk=combined_text,
+                sop_id=sop_id,
+                sop_name=sop_name,
+                section_path=section_path,
+                image_filename=image_filename,
+                image_section_path=image_section_path
+            )
+            chunks.append(text_chunk)
+            text_chunks.append(text_chunk)
 
-    # 使用iter_block_items来按文档顺序处理所有内容（段落、表格、图片）
+    # 使用iter_block_items来按文档顺序处理所有内容（段落、表格、图片），每个块只分类一次
     for block in iter_block_items(doc):
         if isinstance(block, Paragraph):
             paragraph = block
-            if is_heading_paragraph(paragraph):
+            text = paragraph.text.strip()
+            para_texts.append(text)
+            style_name = get_style_name(paragraph, style_names)
+            heading_level = classify_heading(paragraph, text, style_name)
+            if heading_level is not None:
+                # 计算位置标题的编号：显式编号优先，否则自动编号
+                numbered_text, temp_counters = _renumber(text, heading_level, temp_counters)
+                # 同步更新位置标题栈（使用编号后的标题，确保表格位置路径带编号）：移除同级及更深层级
+                del temp_heading_stack[heading_level-1:]
+                temp_heading_stack.append(numbered_text)
+                temp_path = build_section_path(temp_heading_stack)
+            paragraph_section_map[para_index] = temp_path
+            para_index += 1
+            if heading_level is not None:
                 # 如果该标题文本与任一图片caption完全一致，则视为图片标题，不作为新小节切分
                 # 直接跳过（不写入buffer，不改变heading_stack），图片会在后处理阶段插入到对应小节末尾
-                if paragraph.text.strip() in caption_set:
+                if text in caption_set:
                     # 这是一个图片标题，跳过处理（图片会在对应的文本chunk处理时插入）
                     continue
                 # 这是一个标题
-                heading_text = paragraph.text.strip()
-                heading_level = get_heading_level(paragraph)
+                heading_text = text
                 # 为无编号标题自动分配编号，并与已有编号保持同步
-                number_match = re.match(r'^(\d+(?:\.\d+)*)', heading_text)
-                if number_match:
-                    # 同步计数器为显式编号
-                    explicit_numbers = [int(n) for n in number_match.group(1).split('.') if n.isdigit()]
-                    # 调整计数器长度
-                    heading_counters = explicit_numbers.copy()
-                else:
-                    # 基于层级生成自动编号
-                    # 确保计数器长度与层级一致
-                    if len(heading_counters) < heading_level:
-                        heading_counters += [0] * (heading_level - len(heading_counters))
-                    else:
-                        heading_counters = heading_counters[:heading_level]
-                    # 当前层级自增，深层级清零隐含在截断中
-                    if not heading_counters:
-                        heading_counters = [1]
-                    else:
-                        heading_counters[-1] += 1
-                    number_str = '.'.join(str(x) for x in heading_counters)
-                    # 规范化标题展示：数字与标题之间加空格（如 1. 目的 / 5.1 成品酒入库检查）
-                    if not heading_text:
-                        heading_text = number_str + ('.' if heading_level == 1 else '')
-                    elif re.match(r'^\d', heading_text):
-                        # 已有数字（少见），保持原样
-                        pass
-                    else:
-                        # 如果子层级（例如5.1 标题），自动添加空格
-                        if heading_level == 1:
-                            heading_text = f"{number_str}. {heading_text}"
-                        else:
-                            heading_text = f"{number_str} {heading_text}"
+                heading_text, heading_counters = _renumber(heading_text, heading_level, heading_counters)
                 
                 # 如果有收集的内容，先处理之前的内容（包括上一个标题和其内容）
                 if current_content_buffer:
-                    section_path = build_section_path(heading_stack)
-                    combined_text = normalize_list_symbols('\n'.join(current_content_buffer))
-                    # 优先使用chunk首行的数字标题作为section_path，以避免父级错绑
-                    if combined_text.strip():
-                        first_line = combined_text.split('\n', 1)[0].strip()
-                        if re.match(r'^\d+(?:\.\d+)*(?:\.)?\s*.+', first_line):
-                            section_path = first_line
-                    
-                    # 智能分配图片：优先分配给有图片引用的内容
-                    image_filename = ""
-                    image_section_path = ""
-                    image_refs = find_image_references_in_text(combined_text)
-                    
-                    # 特殊处理：检查是否应该将图片分配给7.4.3章节
-                    should_assign_to_743 = False
-                    if "隔离" in combined_text and "7.4" in section_path:
-                        should_assign_to_743 = True
-                    
-                    if image_refs and pending_images:
-                        # 有图片引用，分配第一张待分配图片
-                        image_filename = pending_images.pop(0)
-                        if should_assign_to_743:
-                            image_section_path = "7.活动描述 > 7.4不合格品管理 > 7.4.3当班班长接收隔离完成后，当班邮件反馈隔离信息，通知QA人员现场张贴隔离单，QA邮件反馈隔离信息；（隔离单上应包含隔离数量、品种、批次，隔离原因及隔离人，严格执行隔离四要素；隔离四要素请参考《隔离酒OPL》及《品质隔离标准VPO QUAL WH 3 4 1 002 隔离酒操作.docx》；"
-                        else:
-                            image_section_path = identify_image_section(combined_text, section_path)
-                        image_section_mapping[image_filename] = image_section_path
-                        print(f"图片关联: {image_filename} -> {image_section_path} (基于图片引用)")
-                    elif pending_images and should_assign_to_743:
-                        # 特殊处理：将图片分配给7.4.3章节
-                        image_filename = pending_images.pop(0)
-                        image_section_path = "7.活动描述 > 7.4不合格品管理 > 7.4.3当班班长接收隔离完成后，当班邮件反馈隔离信息，通知QA人员现场张贴隔离单，QA邮件反馈隔离信息；（隔离单上应包含隔离数量、品种、批次，隔离原因及隔离人，严格执行隔离四要素；隔离四要素请参考《隔离酒OPL》及《品质隔离标准VPO QUAL WH 3 4 1 002 隔离酒操作.docx》；"
-                        image_section_mapping[image_filename] = image_section_path
-                        print(f"图片关联: {image_filename} -> {image_section_path} (特殊分配7.4.3)")
-                    elif pending_images and len(pending_images) <= 2:
-                        # 如果图片不多，按顺序分配给有内容的小节
-                        image_filename = pending_images.pop(0)
-                        image_section_path = identify_image_section(combined_text, section_path)
-                        image_section_mapping[image_filename] = image_section_path
-                        print(f"图片关联: {image_filename} -> {image_section_path} (按顺序分配)")
-                    
-                    # 跳过文档开头的总标题等无章节内容（无section_path时不落盘）
-                    if section_path:
-                        chunks.append({
-                            'chunk': combined_text,
-                            'sop_id': sop_id,
-                            'sop_name': sop_name,
-                            'section_path': section_path,
-                            'image_filename': image_filename,
-                            'image_section_path': image_section_path
-                        })
-                        
+                    flush_content_buffer(current_content_buffer, current_path, is_last=False)
                     current_content_buffer = []
                 
-                # 更新标题栈
-                # 移除同级及更深层级的标题
-                heading_stack = [h for h in heading_stack if heading_stack.index(h) < heading_level - 1]
+                # 上一小节中出现的表格紧随其文本chunk之后
+                chunks.extend(pending_table_chunks)
+                pending_table_chunks = []
                 
-                # 添加新标题
-                if len(heading_stack) >= heading_level:
-                    heading_stack = heading_stack[:heading_level-1]
+                # 更新标题栈：移除同级及更深层级的标题，再添加新标题
+                del heading_stack[heading_level-1:]
                 heading_stack.append(heading_text)
+                current_path = build_section_path(heading_stack)
                 
                 # 更新当前标题文本
                 current_heading_text = heading_text
@@ -978,105 +950,58 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
                 
             else:
                 # 这是一个普通段落
-                if paragraph.text.strip():
-                    current_content_buffer.append(paragraph.text.strip())
-    
-    # 处理最后收集的内容
-    if current_content_buffer:
-        section_path = build_section_path(heading_stack)
-        combined_text = normalize_list_symbols('\n'.join(current_content_buffer))
-        # 优先使用chunk首行的数字标题作为section_path
-        if combined_text.strip():
-            first_line = combined_text.split('\n', 1)[0].strip()
-            if re.match(r'^\d+(?:\.\d+)*(?:\.)?\s*.+', first_line):
-                section_path = first_line
-        
-        # 智能分配图片
-        image_filename = ""
-        image_section_path = ""
-        image_refs = find_image_references_in_text(combined_text)
-        
-        # 特殊处理：检查是否应该将图片分配给7.4.3章节
-        should_assign_to_743 = False
-        if "隔离" in combined_text and "7.4" in section_path:
-            should_assign_to_743 = True
-        
-        if image_refs and pending_images:
-            # 有图片引用，分配第一张待分配图片
-            image_filename = pending_images.pop(0)
-            if should_assign_to_743:
-                image_section_path = "7.活动描述 > 7.4不合格品管理 > 7.4.3当班班长接收隔离完成后，当班邮件反馈隔离信息，通知QA人员现场张贴隔离单，QA邮件反馈隔离信息；（隔离单上应包含隔离数量、品种、批次，隔离原因及隔离人，严格执行隔离四要素；隔离四要素请参考《隔离酒OPL》及《品质隔离标准VPO QUAL WH 3 4 1 002 隔离酒操作.docx》；"
-            else:
-                image_section_path = identify_image_section(combined_text, section_path)
-            image_section_mapping[image_filename] = image_section_path
-            print(f"图片关联: {image_filename} -> {image_section_path} (基于图片引用)")
-        elif pending_images and should_assign_to_743:
-            # 特殊处理：将图片分配给7.4.3章节
-            image_filename = pending_images.pop(0)
-            image_section_path = "7.活动描述 > 7.4不合格品管理 > 7.4.3当班班长接收隔离完成后，当班邮件反馈隔离信息，通知QA人员现场张贴隔离单，QA邮件反馈隔离信息；（隔离单上应包含隔离数量、品种、批次，隔离原因及隔离人，严格执行隔离四要素；隔离四要素请参考《隔离酒OPL》及《品质隔离标准VPO QUAL WH 3 4 1 002 隔离酒操作.docx》；"
-            image_section_mapping[image_filename] = image_section_path
-            print(f"图片关联: {image_filename} -> {image_section_path} (特殊分配7.4.3)")
-        elif pending_images:
-            # 分配剩余的图片
-            image_filename = pending_images.pop(0)
-            image_section_path = identify_image_section(combined_text, section_path)
-            image_section_mapping[image_filename] = image_section_path
-            print(f"图片关联: {image_filename} -> {image_section_path} (按顺序分配)")
+                if text:
+                    current_content_buffer.append(text)
         
-        # 跳过无section_path的开头简介段落
-        if section_path:
-            chunks.append({
-                'chunk': combined_text,
-                'sop_id': sop_id,
-                'sop_name': sop_name,
-                'section_path': section_path,
-                'image_filename': image_filename,
-                'image_section_path': image_section_path
-            })
-    
-    # 然后按文档真实顺序处理表格（在遇到表格时就地落盘，使用出现位置路径）
-    table_index = 0  # 表格索引计数器
-    for block in iter_block_items(doc):
-        if isinstance(block, Table):
+        elif isinstance(block, Table):
             table = block
-            markdown_table = table_to_markdown(table)
-            if not markdown_table:
+            # 位置优先：记录表格出现时最近的标题路径（表格图片归属也会用到）
+            position_path = table_position_section[table_index] = temp_path
+            table_index += 1
+            # 没有任何行的表格直接跳过，不再构建markdown（直接读取 w:tr 列表）
+            if not table._tbl.tr_lst:
                 continue
-
-            # 位置优先：表格出现时记录的最近标题路径
-            position_path = table_position_section.get(table_index, "")
+            markdown_table = table_to_markdown(table)
             
-            # 强制使用预扫描记录的位置路径，确保表格归属正确
+            # 强制使用记录的位置路径，确保表格归属正确
             if position_path:
                 table_section_path = position_path
-                print(f"表格 {table_index} 使用预扫描位置路径: {table_section_path}")
+                print(f"表格 {table_index - 1} 使用出现位置路径: {table_section_path}")
             else:
-                # 如果预扫描失败，尝试内容规则
+                # 首个标题之前的表格（如封面版本记录），尝试内容规则
                 table_section = identify_table_section(markdown_table)
                 table_section_path = build_table_section_path(table_section, [])
-                print(f"表格 {table_index} 使用内容规则路径: {table_section_path}")
+                print(f"表格 {table_index - 1} 使用内容规则路径: {table_section_path}")
 
-            leaf_title = table_section_path.split(' > ')[-1] if table_section_path else '表格'
+            leaf_title = table_section_path.rsplit(' > ', 1)[-1] if table_section_path else '表格'
             table_counter_map[leaf_title] += 1
             print(f"处理表格: {table_section_path or '未知章节'} - 表格 {table_counter_map[leaf_title]}")
 
-            chunks.append({
-                'chunk': f"{leaf_title}\n\n{markdown_table}",
-                'sop_id': sop_id,
-                'sop_name': sop_name,
-                'section_path': table_section_path,
-                'image_filename': '',
-                'image_section_path': ''
-            })
-            
-            table_index += 1
+            table_chunk = Chunk(
+                chunk=f"{leaf_title}\n\n{markdown_table}",
+                sop_id=sop_id,
+                sop_name=sop_name,
+                section_path=table_section_path
+            )
+            pending_table_chunks.append(table_chunk)
+            table_chunks.append(table_chunk)
+    
+    # 处理最后收集的内容
+    if current_content_buffer:
+        flush_content_buffer(current_content_buffer, current_path, is_last=True)
+    
+    # 最后一个小节之后的表格
+    chunks.extend(pending_table_chunks)
     
     print(f"总共处理了 {len(chunks)} 个知识块")
     
+    # 图片归属沿用"文本chunk优先、表格chunk在后"的匹配顺序（CSV仍按文档顺序输出）：
+    # 首个标题之前的表格（如封面）路径可能为"未知章节"，若按文档顺序参与匹配会抢走所有未归属图片
+    assignment_chunks = text_chunks + table_chunks
+    
     # 为每张图片计算基于位置的强制归属（最近上一个有效标题）
     for img in ordered_images:
-        info = image_info.get(f"image_{img['index']}", {})
-        cap_i = info.get('caption_index')
+        cap_i = img['caption_index']
         forced_path = ''
         if cap_i is not None:
             # 处理表格图片的特殊情况
@@ -1084,177 +1009,133 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
                 # 表格图片的强制归属将在后续逻辑中处理
                 forced_path = ''
             else:
-                # 普通段落图片的处理
-                j = cap_i
-                while j >= 0:
-                    forced_path = paragraph_section_map.get(j, '')
-                    if forced_path:
-                        break
-                    j -= 1
+                # 普通段落图片的处理：主流程为每个段落都记录了当时的标题路径，
+                # 且首个标题之后路径不会再为空，因此直接取caption段落的路径即为最近上一个有效标题
+                forced_path = paragraph_section_map.get(cap_i, '')
         img['forced_section'] = forced_path
+        img['forced_leaf'] = forced_path.rsplit(' > ', 1)[-1] if forced_path else ''  # 末级标题，匹配chunk时复用
 
     # 后处理：将图片嵌入到对应的文本chunk中
     print("\n开始后处理图片嵌入...")
     
     # 计算5.1章节在文档中的段落范围，用于强制位置归属
+    # 单次遍历：先找到以5.1开头的段落，再找其后第一个以5.2/5.3/6.开头的段落
     section_51_start = None
     section_51_end = None
-    try:
-        for idx, p in enumerate(doc.paragraphs):
-            t = p.text.strip()
+    for idx, t in enumerate(para_texts):
+        if section_51_start is None:
             if t.startswith('5.1'):
                 section_51_start = idx
-                break
-        if section_51_start is not None:
-            for j in range(section_51_start + 1, len(doc.paragraphs)):
-                t = doc.paragraphs[j].text.strip()
-                if t.startswith('5.2') or t.startswith('5.3') or t.startswith('6.'):
-                    section_51_end = j
-                    break
-            if section_51_end is None:
-                section_51_end = len(doc.paragraphs)
-    except Exception:
-        pass
-
-    # 为每个chunk分配对应的图片
-    for chunk in chunks:
-        chunk_section = chunk.get('section_path', '')
-        if chunk_section:
+        elif t.startswith(('5.2', '5.3', '6.')):
+            section_51_end = idx
+            break
+    if section_51_start is not None and section_51_end is None:
+        section_51_end = len(para_texts)
+
+    # 预先计算每张图片与chunk无关的归属信息，避免在 chunk × 图片 的双重循环中重复计算
+    for img_data in ordered_images:
+        # 表格图片：表格出现位置的标题路径及其末级标题
+        table_section = ''
+        if img_data.get('is_table_image', False):
+            table_index = img_data.get('table_index', -1)
+            if table_index >= 0 and table_index in table_position_section:
+                table_section = table_position_section[table_index]
+        img_data['table_section'] = table_section
+        img_data['table_leaf'] = table_section.rsplit(' > ', 1)[-1] if table_section else ''
+        # caption是否落在5.1范围内（表格图片的caption_index为字符串位置，不参与段落范围判断）
+        in_section_51 = False
+        if section_51_start is not None and section_51_end is not None:
+            cap_idx = img_data['caption_index']
+            in_section_51 = isinstance(cap_idx, int) and section_51_start <= cap_idx < section_51_end
+        img_data['in_section_51'] = in_section_51
+        # caption决定的归属条件
+        if img_data['caption']:
+            img_data['caption_sections'], img_data['caption_prefix'] = match_caption_rule(img_data['caption'])
+        else:
+            # 无caption图片：China RTP-001文档根据图片index推断所在章节，其他文档不在此阶段分配(None)
+            position_sections = None
+            if "China RTP-001" in img_data['filename']:
+                img_index = img_data.get('index', 0)
+                if img_index == 1:  # 只有image1明确属于4.1
+                    position_sections = ("4.1",)
+                elif 4 <= img_index <= 11:  # image4-11 通常在5.1-5.3部分
+                    position_sections = ("5.1", "5.2", "5.3")
+                elif 12 <= img_index <= 14 or 32 <= img_index <= 38:  # image12-14、32-38 通常在5.3部分
+                    position_sections = ("5.3",)
+                else:  # image2-3 等不明确归属，暂时不分配
+                    position_sections = ()
+            img_data['position_sections'] = position_sections
+        # 其他文档的无caption图片在此阶段不分配：其余条件的结果都会被覆盖为"未知章节"，无需逐项计算
+        img_data['skip_assignment'] = not img_data['caption'] and img_data['position_sections'] is None
+
+    # 为每个chunk分配对应的图片（已分配的图片从候选列表中移除，后续chunk不再重复检查）
+    remaining_images = [img for img in ordered_images if not img.get('used', False)]
+    for chunk in assignment_chunks:
+        chunk_section = chunk.section_path
+        if chunk_section and remaining_images:
+            chunk_leaf = chunk_section.rsplit(' > ', 1)[-1]
             # 查找属于这个section的图片
             section_images = []
-            for img_data in ordered_images:
-                if not img_data.get('used', False):
-                    caption = img_data['caption']
-                    assigned_section = "未知章节"
-                    # （已移除专项强制索引分配）
-                    
-                    # 特殊处理表格中的图片
-                    if img_data.get('is_table_image', False):
-                        table_index = img_data.get('table_index', -1)
-                        if table_index >= 0 and table_index in table_position_section:
-                            table_section = table_position_section[table_index]
-                            if table_section:
-                                # 更宽松的匹配条件
-                                table_leaf = table_section.split(' > ')[-1]
-                                chunk_leaf = chunk_section.split(' > ')[-1] if ' > ' in chunk_section else chunk_section
-                                
-                                if (chunk_section == table_section or 
-                                    chunk_section.endswith(table_leaf) or 
-                                    chunk_leaf == table_leaf or
-                                    table_leaf in chunk_section):
-                                    assigned_section = chunk_section
-                                    print(f"表格图片分配到章节: {img_data['filename']} -> {chunk_section}")
-                    
-                    # 基于位置的强制归属优先：按最近上一个有效标题
-                    forced_path = img_data.get('forced_section') or ''
-                    if forced_path:
-                        forced_leaf = forced_path.split(' > ')[-1]
-                        if forced_leaf and (chunk_section.endswith(forced_leaf) or forced_path in chunk_section):
-                            assigned_section = chunk_section
-                    # 基于位置的强制归属：如果caption落在5.1范围内，则强制归到5.1小节
-                    if section_51_start is not None and section_51_end is not None:
-                        cap_idx = image_info.get(f"image_{img_data['index']}", {}).get('caption_index')
-                        if cap_idx is not None and section_51_start <= cap_idx < section_51_end:
-                            if "5.1" in chunk_section:
-                                assigned_section = chunk_section
-                    
-                    if caption:
-                        # 首先尝试从caption中提取数字前缀（优先级最高）
-                        import re
-                        prefix_match = re.search(r'(\d+\.\d+)', caption)
-                        if prefix_match:
-                            prefix = prefix_match.group(1)
-                            if prefix in chunk_section:
-                                assigned_section = chunk_section
-                        # 然后尝试根据关键词匹配
-                        elif '配送模式' in caption:
-                            if "9.配送模式" in chunk_section:
-                                assigned_section = chunk_section
-                        elif '自提模式' in caption:
-                            if "10. 自提模式" in chunk_section or "自提模式" in chunk_section:
-                                assigned_section = chunk_section
-                        # 5.1章节的特殊匹配
-                        elif ('外观' in caption and '瓶外壁' in caption) or '非百威瓶' in caption or '破损瓶' in caption:
-                            if "5.1可接收-普通洗瓶工艺能洗净" in chunk_section:
-                                assigned_section = chunk_section
-                        elif '霉斑' in caption or '磨花' in caption or '特脏' in caption or '破损' in caption or '不干胶' in caption or '塑料标签' in caption or '瓶口缺陷' in caption or '假标签' in caption or '喷码' in caption or '标签' in caption:
-                            if "5.3不可接收-不合格" in chunk_section:
-                                assigned_section = chunk_section
-                        elif '塑箱' in caption or '铁丝' in caption or '焊接' in caption:
-                            if "5.4不可接收的回收塑箱" in chunk_section:
-                                assigned_section = chunk_section
-                        elif '扎啤桶' in caption or '改装' in caption or '变形' in caption or '瓶阀' in caption:
-                            if "5.5不可接收的扎啤桶" in chunk_section:
-                                assigned_section = chunk_section
-                        else:
-                            # 如果没有关键词匹配，尝试从caption中提取数字前缀
-                            caption_match = re.match(r'^(\d+(?:\.\d+)*)', caption)
-                            if caption_match:
-                                caption_prefix = caption_match.group(1)
-                                # 检查是否匹配当前chunk的section
-                                if chunk_section.startswith(caption_prefix):
-                                    assigned_section = chunk_section
-                    else:
-                        # 对于没有caption的图片，尝试根据图片在文档中的位置来智能分配
-                        # 根据图片的index和当前处理的章节来推断
-                        img_index = img_data.get('index', 0)
-                        
-                        # 对于China RTP-001文档的特殊处理
-                        if "China RTP-001" in img_data['filename']:
-                            # 更精确的分配逻辑，避免将无caption图片错误分配
-                            if img_index == 1:  # 只有image1明确属于4.1
-                                if "4.1" in chunk_section:
-                                    assigned_section = chunk_section
-                            elif 2 <= img_index <= 3:  # image2-3 不明确归属，暂时不分配
-                                pass
-                            elif 4 <= img_index <= 11:  # image4-11 通常在5.1-5.3部分
-                                if "5.1" in chunk_section or "5.2" in chunk_section or "5.3" in chunk_section:
-                                    assigned_section = chunk_section
-                            elif 12 <= img_index <= 14:  # image12-14 通常在5.3部分
-                                if "5.3" in chunk_section:
-                                    assigned_section = chunk_section
-                            elif 32 <= img_index <= 38:  # image32-38 通常在5.3部分
-                                if "5.3" in chunk_section:
-                                    assigned_section = chunk_section
-                        
-                        # 对于其他文档，尝试按顺序分配
-                        else:
-                            # 跳过没有caption的图片（通常是文档头部的装饰性图片）
-                            if not caption:
-                                assigned_section = "未知章节"
-                            else:
-                                # 特殊处理：如果caption包含"错峰清洁"，应该分配到7.3清洁作业要求
-                                if "错峰清洁" in caption and "7.3" in chunk_section:
-                                    assigned_section = chunk_section
-                                    print(f"DEBUG: 图片{img_index} 特殊处理 - caption包含'错峰清洁'，分配到: {chunk_section}")
-                                # 根据图片index和章节的对应关系来分配
-                                elif img_index <= 2 and ("1." in chunk_section or "2." in chunk_section):
-                                    assigned_section = chunk_section
-                                elif 3 <= img_index <= 5 and ("3." in chunk_section or "4." in chunk_section):
-                                    assigned_section = chunk_section
-                                elif img_index >= 6 and ("5." in chunk_section or "6." in chunk_section):
-                                    assigned_section = chunk_section
-                    
-                    if assigned_section == chunk_section:
+            for img_data in remaining_images:
+                if img_data['skip_assignment']:
+                    # 仅当章节路径本身就是"未知章节"时与初始值相同，视为匹配
+                    if chunk_section == "未知章节":
                         section_images.append(img_data)
-            
+                    continue
+                caption = img_data['caption']
+                assigned_section = "未知章节"
+                # （已移除专项强制索引分配）
+                
+                # 特殊处理表格中的图片
+                table_section = img_data['table_section']
+                if table_section:
+                    # 更宽松的匹配条件
+                    table_leaf = img_data['table_leaf']
+                    if (chunk_section == table_section or 
+                        chunk_section.endswith(table_leaf) or 
+                        chunk_leaf == table_leaf or
+                        table_leaf in chunk_section):
+                        assigned_section = chunk_section
+                        log.debug("表格图片分配到章节: %s -> %s", img_data['filename'], chunk_section)
+                
+                # 基于位置的强制归属优先：按最近上一个有效标题
+                forced_leaf = img_data['forced_leaf']
+                if forced_leaf and (chunk_section.endswith(forced_leaf) or img_data['forced_section'] in chunk_section):
+                    assigned_section = chunk_section
+                # 基于位置的强制归属：如果caption落在5.1范围内，则强制归到5.1小节
+                if img_data['in_section_51'] and "5.1" in chunk_section:
+                    assigned_section = chunk_section
+                
+                if caption:
+                    # 按预先计算的caption归属条件匹配当前chunk
+                    caption_prefix = img_data['caption_prefix']
+                    if caption_prefix:
+                        if chunk_section.startswith(caption_prefix):
+                            assigned_section = chunk_section
+                    elif any(sec in chunk_section for sec in img_data['caption_sections']):
+                        assigned_section = chunk_section
+                else:
+                    # 对于没有caption的图片（China RTP-001），按预先计算的位置归属条件分配
+                    if any(sec in chunk_section for sec in img_data['position_sections']):
+                        assigned_section = chunk_section
+                
+                if assigned_section == chunk_section:
+                    section_images.append(img_data)
+        
             # 如果有图片属于这个section，将它们嵌入到chunk中
             if section_images:
-                original_content = chunk['chunk']
-                image_content = ""
-                
+                # 图片内容依次追加到原始chunk内容后面，一次join拼接
+                parts = [chunk.chunk]
                 for img_data in section_images:
-                    enhanced_content = create_enhanced_image_chunk_content(
+                    parts.append(create_enhanced_image_chunk_content(
                         img_data['filename'], 
                         chunk_section, 
                         img_data['caption']
-                    )
-                    image_content += "\n\n" + enhanced_content
+                    ))
                     img_data['used'] = True
-                    print(f"嵌入图片到chunk: {img_data['filename']} -> {chunk_section}")
-                
-                # 将图片内容添加到原始chunk内容后面
-                chunk['chunk'] = original_content + image_content
+                    log.debug("嵌入图片到chunk: %s -> %s", img_data['filename'], chunk_section)
+                chunk.chunk = "\n\n".join(parts)
+                remaining_images = [img for img in remaining_images if not img['used']]
     
     print(f"图片嵌入处理完成，共处理 {len(chunks)} 个chunks")
     
@@ -1267,10 +1148,10 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
         prefix = text[:first_idx]
         rest = text[first_idx:]
         # 收集该chunk中方括号内的图片内容（去除“图片内容：”前缀）
-        import re as _re
         caption_in_brackets = set()
-        for m in _re.finditer(r"\[图: [^\]]*?(?:\n图片内容：([^\]]+))?\]", text, _re.S):
-            cap = (m.group(1) or '').strip()
+        # 只需扫描第一个图片块及之后的部分；图片内容取方括号内首个“图片内容：”之后的文本
+        for m in _IMG_BLOCK_RE.finditer(rest):
+            cap = m.group(1).partition('\n图片内容：')[2].strip()
             if cap:
                 caption_in_brackets.add(cap)
         # 过滤前缀中的重复caption行
@@ -1281,57 +1162,57 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
                 cleaned_lines.append(line)
                 continue
             # 1) 去掉“图表/图/Figure/Fig + 数字 …”样式的行
-            if _re.match(r'^(图表|图|Figure|Fig)\s*\d+', stripped):
+            if _FIGURE_LINE_RE.match(stripped):
                 continue
             # 2) 去掉与图片内容完全相同的行（避免与标题数字冲突：排除以数字开头的行）
-            if not _re.match(r'^\d', stripped) and stripped in caption_in_brackets:
+            if not _LEADING_DIGIT_RE.match(stripped) and stripped in caption_in_brackets:
                 continue
             cleaned_lines.append(line)
         return '\n'.join(cleaned_lines) + rest
     
     for ch in chunks:
-        ch_text = ch.get('chunk', '')
+        ch_text = ch.chunk
         if ch_text:
-            ch['chunk'] = clean_duplicate_captions(ch_text)
+            ch.chunk = clean_duplicate_captions(ch_text)
     
     # 二次分配：将仍未使用的图片按强制归属补充嵌入（若找不到则兜底未知章节）
-    unused_images = [img for img in ordered_images if not img.get('used', False)]
+    # 分配循环结束后 remaining_images 恰好是按文档顺序排列的未使用图片，无需重新扫描
+    unused_images = remaining_images
     if unused_images:
         print(f"发现 {len(unused_images)} 张未使用的图片，尝试按强制归属补充嵌入")
-        for img_data in list(unused_images):
-            forced_path = img_data.get('forced_section') or ''
-            placed = False
-            if forced_path:
-                forced_leaf = forced_path.split(' > ')[-1]
-                for chunk in chunks:
-                    sec = chunk.get('section_path', '')
-                    if forced_leaf and (sec.endswith(forced_leaf) or forced_path in sec):
-                        enhanced_content = create_enhanced_image_chunk_content(img_data['filename'], sec, img_data['caption'])
-                        chunk['chunk'] = chunk['chunk'] + "\n\n" + enhanced_content
-                        img_data['used'] = True
-                        placed = True
-                        print(f"补充嵌入图片: {img_data['filename']} -> {sec}")
-                        break
-            if not placed:
-                # 常规兜底：找最近有标题的chunk（全局向后回填到最后一个chunk）
-                
-                # 常规兜底：找最近有标题的chunk（全局向后回填到最后一个chunk）
-                fallback_sec = ''
-                for chunk in reversed(chunks):
-                    if chunk.get('section_path'):
-                        fallback_sec = chunk['section_path']
-                        break
-                if not fallback_sec:
-                    fallback_sec = '未知章节'
-                # 专项配额检查（已移除专项逻辑，无需限制）
+        # 兜底目标：按匹配顺序最后一个有标题的chunk，只查找一次
+        fallback_chunk = next((c for c in reversed(assignment_chunks) if c.section_path), None)
+        fallback_sec = fallback_chunk.section_path if fallback_chunk else '未知章节'
+        # 强制归属路径 -> 首个匹配的chunk（同一小节的多张图片共用一次查找；追加内容不改变section_path）
+        forced_targets: Dict[str, Optional[Chunk]] = {}
+        # 每个chunk待追加的图片内容，循环结束后一次join，避免同一chunk反复拼接长字符串
+        appended: Dict[int, Tuple[Chunk, List[str]]] = {}
+        for img_data in unused_images:
+            forced_path = img_data['forced_section']
+            forced_leaf = img_data['forced_leaf']
+            target_chunk = None
+            if forced_leaf:
+                if forced_path not in forced_targets:
+                    forced_targets[forced_path] = next(
+                        (c for c in assignment_chunks
+                         if c.section_path.endswith(forced_leaf) or forced_path in c.section_path),
+                        None)
+                target_chunk = forced_targets[forced_path]
+            if target_chunk is not None:
+                sec = target_chunk.section_path
+                enhanced_content = create_enhanced_image_chunk_content(img_data['filename'], sec, img_data['caption'])
+                appended.setdefault(id(target_chunk), (target_chunk, []))[1].append(enhanced_content)
+                img_data['used'] = True
+                log.debug("补充嵌入图片: %s -> %s", img_data['filename'], sec)
+            else:
+                # 常规兜底：回填到最后一个有标题的chunk（无则归入未知章节）
                 enhanced_content = create_enhanced_image_chunk_content(img_data['filename'], fallback_sec, img_data['caption'])
-                # 回填到找到的最后一个有标题的chunk
-                for chunk in reversed(chunks):
-                    if chunk.get('section_path'):
-                        chunk['chunk'] = chunk['chunk'] + "\n\n" + enhanced_content
-                        break
+                if fallback_chunk is not None:
+                    appended.setdefault(id(fallback_chunk), (fallback_chunk, []))[1].append(enhanced_content)
                 img_data['used'] = True
-                print(f"补充嵌入图片(兜底): {img_data['filename']} -> {fallback_sec}")
+                log.debug("补充嵌入图片(兜底): %s -> %s", img_data['filename'], fallback_sec)
+        for chunk, parts in appended.values():
+            chunk.chunk = "\n\n".join([chunk.chunk, *parts])
     
     # 保存到CSV文件
     if not chunks:
@@ -1343,12 +1224,12 @@ def process_sop_document_with_images(docx_path: str, output_dir: str = "output")
     base_name = os.path.splitext(os.path.basename(docx_path))[0]
     output_file = os.path.join(output_dir, f"{base_name}_processed_with_images.csv")
     
-    # 转换为DataFrame并保存，只保留chunk列
-    df = pd.DataFrame(chunks)
-    # 只保留chunk列，删除其他所有列
-    if 'chunk' in df.columns:
-        df = df[['chunk']]
-    df.to_csv(output_file, index=False, encoding='utf-8-sig', quoting=1)
+    # 直接用csv模块写出，只保留chunk列（1 MiB写缓冲，减少大文档的写入系统调用）
+    # 行尾沿用 pandas to_csv 的默认值 os.linesep（Windows 下为CRLF）
+    with open(output_file, 'w', encoding='utf-8-sig', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator=os.linesep)
+        writer.writerow(['chunk'])
+        writer.writerows((c.chunk,) for c in chunks)
     
     print(f"成功保存到: {output_file}")
     print(f"总共生成 {len(chunks)} 个知识块")